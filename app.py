@@ -1,11 +1,22 @@
+import hashlib
 import io
-import zipfile
-from typing import Dict, Tuple
+import logging
+import math
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from importlib.metadata import version
+from types import SimpleNamespace
+from typing import Dict, List, Optional, Tuple
 
 import numpy as np
+import onnxruntime as ort
 import streamlit as st
-from PIL import Image
-from rembg import remove, new_session
+import streamlit_drawable_canvas
+from PIL import Image, ImageDraw
+from rembg.sessions import sessions_class
+from rembg.sessions.u2net_custom import U2netCustomSession
 from streamlit_drawable_canvas import st_canvas
 
 
@@ -16,6 +27,9 @@ st.set_page_config(page_title="Quitar fondo → Fondo blanco", page_icon="🖼
 st.title("🖼️ Quitar fondo y refinar con pincel")
 st.caption("IA para quitar fondo + refinado manual: pinta verde para CONSERVAR y rojo para ELIMINAR.")
 
+KEEP_COLOR = "#00FF00"    # color del pincel CONSERVAR
+REMOVE_COLOR = "#FF0000"  # color del pincel ELIMINAR
+
 
 # ──────────────────────────────────────────────────────────────────────────────
 # Estado para refinado
@@ -25,44 +39,440 @@ if "refine" not in st.session_state:
 
 
 # ──────────────────────────────────────────────────────────────────────────────
-# Modelo (carga diferida y cacheado)
+# Modelo (cargado una vez por proceso y cacheado)
 # ──────────────────────────────────────────────────────────────────────────────
+def _quantized_model_path(model_path: str) -> Optional[str]:
+    """
+    Copia INT8 (cuantización dinámica de pesos) del modelo ONNX, generada una sola
+    vez junto al original. Devuelve None (se sigue con FP32) si falta el paquete
+    opcional `onnx` o si la cuantización falla.
+    """
+    int8_path = os.path.splitext(model_path)[0] + ".int8.onnx"
+    if not os.path.exists(int8_path):
+        try:
+            from onnxruntime.quantization import QuantType, quantize_dynamic
+        except ImportError:
+            return None
+        tmp_path = int8_path + ".tmp"
+        try:
+            quantize_dynamic(model_path, tmp_path, weight_type=QuantType.QUInt8)
+            os.replace(tmp_path, int8_path)  # sin ficheros a medias si se corta
+        except Exception:
+            # Disco lleno, directorio de solo lectura, versión de onnx incompatible...
+            logging.getLogger(__name__).warning(
+                "No se pudo cuantizar %s a INT8; se usa el modelo FP32", model_path, exc_info=True
+            )
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            return None
+    return int8_path
+
 @st.cache_resource(show_spinner=False)
 def _create_session(model_name: str = "u2net"):
-    return new_session(model_name)
+    """
+    Como rembg.new_session, pero con las opciones de ONNX Runtime fijadas aquí:
+    hilos por operador según OMP_NUM_THREADS si está definido (si no, 0: ONNX
+    Runtime decide y respeta la afinidad de CPU del contenedor), ejecución
+    secuencial y todas las optimizaciones de grafo.
+    rembg ya elige CUDA/ROCm si onnxruntime los tiene disponibles.
+    Con U2NET_INT8=1 y sin GPU se usa el modelo cuantizado a INT8.
+    """
+    sess_opts = ort.SessionOptions()
+    omp_threads = os.environ.get("OMP_NUM_THREADS", "").strip()
+    # Solo un entero positivo simple; vacío, "4,2" (lista por nivel) u otros -> 0
+    sess_opts.intra_op_num_threads = int(omp_threads) if omp_threads.isdecimal() else 0
+    sess_opts.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
+    sess_opts.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+
+    for session_class in sessions_class:
+        if session_class.name() == model_name:
+            if os.environ.get("U2NET_INT8") == "1" and ort.get_device() == "CPU":
+                int8_path = _quantized_model_path(str(session_class.download_models()))
+                if int8_path is not None:
+                    return U2netCustomSession("u2net_custom", sess_opts, model_path=int8_path)
+            return session_class(model_name, sess_opts)
+    raise ValueError(f"Modelo desconocido: {model_name}")
+
+# Cargar el modelo al arrancar y no al procesar la primera imagen (solo tarda la primera vez)
+with st.spinner("Cargando modelo de IA…"):
+    SESSION = _create_session("u2net")
+
+# Pre/posproceso de U2Net, igual que rembg (U2netSession.predict)
+U2NET_SIZE = (320, 320)
+U2NET_MEAN = (0.485, 0.456, 0.406)
+U2NET_STD = (0.229, 0.224, 0.225)
+
+def segment_batch(images: List[Image.Image], session) -> List[Image.Image]:
+    """
+    Segmenta varias imágenes con U2Net en una sola pasada ONNX (B,3,320,320) y
+    devuelve una máscara 'L' por imagen a la resolución del modelo (320×320): se
+    escala una sola vez, al tamaño final, en compose_on_background. Si el modelo
+    tiene el lote fijo a 1, ejecuta las imágenes una a una con el mismo preproceso.
+    """
+    inner = session.inner_session
+    model_input = inner.get_inputs()[0]
+    tensors = [session.normalize(img, U2NET_MEAN, U2NET_STD, U2NET_SIZE)[model_input.name] for img in images]
+    if isinstance(model_input.shape[0], int):
+        preds = np.concatenate([inner.run(None, {model_input.name: t})[0] for t in tensors])
+    else:
+        preds = inner.run(None, {model_input.name: np.concatenate(tensors)})[0]
+
+    masks = []
+    for pred in preds[:, 0]:
+        mi, ma = pred.min(), pred.max()
+        pred = (pred - mi) / ((ma - mi) or 1)
+        masks.append(Image.fromarray((pred.clip(0, 1) * 255).astype(np.uint8), mode="L"))
+    return masks
+
+@st.cache_resource(show_spinner=False)
+def _inference_executor() -> ThreadPoolExecutor:
+    # Un solo hilo: ONNX Runtime ya reparte cada inferencia entre todos los núcleos
+    return ThreadPoolExecutor(max_workers=1, thread_name_prefix="u2net")
+
+MaskKey = Tuple[str, Tuple[int, int]]  # (huella, tamaño de la imagen decodificada)
+
+class MaskStore:
+    """
+    Máscara (hecha o en curso, como Future) por imagen, para todas las sesiones y
+    reruns: un rerun interrumpido no tira las máscaras ya calculadas ni vuelve a
+    encolarlas. LRU con tope de entradas; solo se expulsan Futures terminados.
+    Lo usan a la vez los hilos de varias sesiones y el de inferencia, de ahí el lock.
+    """
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self.futures: "OrderedDict[MaskKey, Future]" = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key: MaskKey) -> Optional[Future]:
+        with self.lock:
+            future = self.futures.get(key)
+            if future is not None:
+                self.futures.move_to_end(key)
+            return future
+
+    def claim(self, key: MaskKey, future: Future) -> Future:
+        """Guarda `future` si la clave está libre; devuelve el Future que queda en ella."""
+        with self.lock:
+            current = self.futures.setdefault(key, future)
+            self.futures.move_to_end(key)
+            if len(self.futures) > self.max_entries:
+                done = [k for k, f in self.futures.items() if f.done()]
+                for k in done[:len(self.futures) - self.max_entries]:
+                    del self.futures[k]
+            return current
+
+    def discard(self, key: MaskKey, future: Future) -> None:
+        with self.lock:
+            if self.futures.get(key) is future:
+                del self.futures[key]
+
+@st.cache_resource(show_spinner=False)
+def _mask_store() -> MaskStore:
+    return MaskStore(max_entries=256)  # ~100 kB por máscara de 320×320
+
+def _run_batch(store: MaskStore, keys: List[MaskKey], futures: List[Future],
+               images: List[Image.Image], session) -> None:
+    # Corre en el hilo de inferencia (sin ScriptRunContext): no llama a nada de st.*
+    try:
+        masks = segment_batch(images, session)
+    except BaseException as e:
+        for key, future in zip(keys, futures):
+            store.discard(key, future)  # que el siguiente rerun lo reintente
+            future.set_exception(e)
+    else:
+        for future, mask in zip(futures, masks):
+            future.set_result(mask)
+
+class MaskBatch:
+    """
+    Imágenes de este rerun cuya máscara no está en _mask_store. start() las infiere
+    juntas con segment_batch en un hilo aparte mientras se pinta la página y deja
+    en el almacén un Future por imagen; mask() espera al suyo. Si otra sesión o un
+    rerun anterior ya la encoló, se reutiliza su Future en vez de inferirla otra vez.
+    """
+
+    def __init__(self, session):
+        self.session = session
+        self.pending: Dict[MaskKey, Image.Image] = {}
+        self.futures: Dict[MaskKey, Future] = {}  # los de este rerun, aunque el almacén los suelte
+
+    def add(self, key: MaskKey, image: Image.Image) -> None:
+        future = _mask_store().get(key)
+        if future is not None:
+            self.futures[key] = future
+        else:
+            self.pending[key] = image
+
+    def start(self, executor: ThreadPoolExecutor) -> None:
+        store = _mask_store()
+        keys, futures, images = [], [], []
+        for key, image in self.pending.items():
+            future = Future()
+            self.futures[key] = store.claim(key, future)
+            if self.futures[key] is future:  # nadie la encoló entretanto
+                keys.append(key)
+                futures.append(future)
+                images.append(image)
+        self.pending = {}
+        if keys:
+            executor.submit(_run_batch, store, keys, futures, images, self.session)
+
+    def mask(self, key: MaskKey, image: Image.Image) -> Image.Image:
+        if key not in self.futures:
+            self.pending[key] = image
+            self.start(_inference_executor())
+        return self.futures[key].result()
+
+def file_digest(file_bytes: bytes) -> str:
+    """
+    Huella corta del archivo (16 bytes, hex) para usar como clave de caché.
+    Las funciones cacheadas reciben la huella y los datos pesados con '_',
+    así Streamlit no vuelve a hashear megabytes en cada rerun.
+    """
+    return hashlib.blake2b(file_bytes, digest_size=16).hexdigest()
+
+def decode_upload(file_bytes: bytes, max_width: int) -> Image.Image:
+    """
+    Decodifica la subida a RGB. Si es JPEG y hay ancho máximo, usa draft() para que
+    libjpeg decodifique directamente a escala 1/2, 1/4 o 1/8 (nunca por debajo de max_width).
+    """
+    img = Image.open(io.BytesIO(file_bytes))
+    if img.format == "JPEG" and max_width > 0 and img.width > max_width:
+        img.draft("RGB", (max_width, math.ceil(img.height * max_width / img.width)))
+    if img.mode != "RGB":
+        return img.convert("RGB")  # convert() ya decodifica
+    img.load()  # ya es RGB: decodificar (a la escala del draft) sin copia extra
+    return img
+
+def get_mask(file_key: str, image: Image.Image, batch: MaskBatch) -> Image.Image:
+    """
+    Máscara de la IA (PIL mode 'L') a 320×320, ~100 kB por archivo: la del
+    almacén compartido si ya está, o la del lote en segundo plano al terminar.
+    Es un objeto compartido entre sesiones: solo se lee (resize, composite).
+    """
+    return batch.mask((file_key, image.size), image)
+
+@st.cache_data(show_spinner=False, max_entries=16)
+def get_fg_bool(file_key: str, size: Tuple[int, int], _mask_L: Image.Image) -> np.ndarray:
+    """
+    Máscara de la IA a tamaño original y umbralizada (>= 128) como array bool (H,W),
+    para el refinado. Se calcula una vez por archivo, no en cada «Aplicar».
+    """
+    return np.greater_equal(np.asarray(_mask_L.resize(size, Image.LANCZOS)), 128)
 
 @st.cache_data(show_spinner=False)
-def get_rgba_and_mask(file_bytes: bytes, model_name: str = "u2net") -> Tuple[Image.Image, Image.Image]:
+def make_canvas_bg(file_key: str, _image: Image.Image, canvas_w: int, canvas_h: int) -> Image.Image:
+    """
+    Fondo RGB del lienzo a su escala, calculado una vez por archivo y no en cada trazo.
+    `reducing_gap` hace una reducción BOX previa (la ruta rápida de thumbnail())
+    y deja el filtro solo para el último factor ≤ 2. BICUBIC basta para un fondo
+    sobre el que se pinta; LANCZOS queda para el resultado descargable.
+    """
+    if _image.size == (canvas_w, canvas_h):
+        return _image
+    return _image.resize((canvas_w, canvas_h), Image.BICUBIC, reducing_gap=2.0)
+
+@st.cache_data(show_spinner=False, max_entries=16)
+def _canvas_bg_png(image_id: str, _image: Image.Image) -> bytes:
+    # image_id ya incluye el md5 de los píxeles que calcula el componente
+    return to_png(_image)
+
+def _canvas_image_to_url(image, width, clamp, channels, output_format, image_id):
     """
-    Ejecuta rembg y devuelve:
-      - fg_rgba: imagen RGBA con alfa (PIL)
-      - mask_L: canal alfa como máscara (PIL mode 'L')
+    st_canvas vuelve a codificar el fondo como PNG (zlib nivel 6) en cada rerun:
+    ~200 ms por lienzo de 1024 px. Se le da el PNG ya hecho (nivel 1), cacheado por
+    el identificador que el componente deriva del contenido de la imagen.
     """
-    session = _create_session(model_name)
-    out_bytes = remove(file_bytes, session=session)
-    fg_rgba = Image.open(io.BytesIO(out_bytes)).convert("RGBA")
-    mask_L = fg_rgba.split()[3]
-    return fg_rgba, mask_L
+    return _st_image_to_url(_canvas_bg_png(image_id, image), width, clamp, channels, output_format, image_id)
+
+# Depende de internos de estas versiones exactas (el módulo global st_image del
+# componente y la firma posicional de image_to_url): con otras se deja la ruta original
+CANVAS_PATCH_VERSIONS = {"streamlit": "1.37.1", "streamlit-drawable-canvas": "0.9.3"}
+if all(version(pkg) == ver for pkg, ver in CANVAS_PATCH_VERSIONS.items()):
+    from streamlit.elements.image import image_to_url as _st_image_to_url
+    streamlit_drawable_canvas.st_image = SimpleNamespace(image_to_url=_canvas_image_to_url)
+
+@st.cache_resource(show_spinner=False, max_entries=8)
+def solid_bg(size: Tuple[int, int], color: Tuple[int, int, int]) -> Image.Image:
+    """
+    Fondo de color sólido por (tamaño, color). Compartido y de solo lectura:
+    compose_on_background lo usa con Image.composite, que no modifica sus entradas.
+    """
+    return Image.new("RGB", size, color)
 
 def compose_on_background(orig_rgb: Image.Image, mask_L: Image.Image,
-                          bg_rgb: Tuple[int, int, int], max_width: int) -> bytes:
+                          bg_rgb: Tuple[int, int, int], max_width: int,
+                          resample: int = Image.NEAREST) -> Image.Image:
     """
-    Pega orig_rgb sobre un color sólido usando mask_L. Devuelve PNG en bytes.
+    Pega orig_rgb sobre un color sólido usando mask_L. Devuelve la imagen RGB (PIL).
+    `resample` escala mask_L al tamaño de salida: LANCZOS para la máscara de la IA
+    a 320×320 (como hace rembg), NEAREST para la binaria del refinado (0/255).
     """
     if isinstance(max_width, int) and max_width > 0:
         w, h = orig_rgb.size
         if w > max_width:
             new_h = int(h * (max_width / w))
-            orig_rgb = orig_rgb.resize((max_width, new_h), Image.LANCZOS)
-            mask_L = mask_L.resize((max_width, new_h), Image.NEAREST)
+            # reducing_gap: reducción BOX previa y LANCZOS solo para el último factor ≤ 2
+            orig_rgb = orig_rgb.resize((max_width, new_h), Image.LANCZOS, reducing_gap=2.0)
+    if mask_L.size != orig_rgb.size:
+        mask_L = mask_L.resize(orig_rgb.size, resample)
+
+    # La máscara se mantiene en modo 'L' también cuando es binaria (refinado): en Pillow
+    # el composite con máscara 'L' es más rápido que con modo '1' o que np.where
+    return Image.composite(orig_rgb, solid_bg(orig_rgb.size, bg_rgb), mask_L)
+
+def to_png(img: Image.Image) -> bytes:
+    """
+    Codifica una imagen PIL como PNG en bytes. compress_level=1: zlib varias veces
+    más rápido que el nivel 6 por defecto, con un tamaño casi igual en fotos.
+    """
+    buf = io.BytesIO()
+    img.save(buf, format="PNG", compress_level=1)
+    return buf.getvalue()
 
-    bg = Image.new("RGB", orig_rgb.size, bg_rgb)
-    bg.paste(orig_rgb, mask=mask_L)
+@st.cache_data(show_spinner=False, max_entries=16)
+def compose_png(file_key: str, bg_rgb: Tuple[int, int, int], max_width: int,
+                _orig_rgb: Image.Image, _mask_L: Image.Image) -> bytes:
+    """
+    compose_on_background + to_png cacheados: el PNG solo se rehace si cambian la
+    imagen, el color de fondo o el ancho máximo, no en cada rerun por pincel, modo, etc.
+    """
+    return to_png(compose_on_background(_orig_rgb, _mask_L, bg_rgb, max_width, Image.LANCZOS))
+
+@st.cache_data(show_spinner=False, max_entries=4)
+def zip_pngs(entries: Tuple[Tuple[str, str], ...], bg_rgb: Tuple[int, int, int], max_width: int,
+             _pngs: List[bytes]) -> bytes:
+    """
+    Empaqueta los PNG en un ZIP sin recomprimir (ZIP_STORED): ya van comprimidos
+    con deflate, así que pasarles zlib otra vez solo gasta CPU. Cacheado por
+    (nombre, huella) de cada entrada, color de fondo y ancho máximo: no se rehace
+    en cada rerun por pincel, modo, etc.
+    """
+    import zipfile  # solo hace falta al descargar varias
 
     buf = io.BytesIO()
-    bg.save(buf, format="PNG")
-    buf.seek(0)
-    return buf.read()
+    with zipfile.ZipFile(buf, "w", zipfile.ZIP_STORED) as zf:
+        for (name, _), data in zip(entries, _pngs):
+            zf.writestr(name, data)
+    return buf.getvalue()
+
+def refine_mask(fg_bool: np.ndarray, keep_bits: np.ndarray, remove_bits: np.ndarray,
+                canvas_size: Tuple[int, int], orig_size: Tuple[int, int]) -> Image.Image:
+    """
+    Aplica las pinceladas (máscaras empaquetadas a escala del lienzo) sobre la
+    máscara de la IA ya umbralizada, a tamaño original. Devuelve una máscara
+    binaria 'L' (0/255).
+    """
+    orig_w, orig_h = orig_size
+    canvas_w, canvas_h = canvas_size
+
+    # Vecino más próximo (centro de cada píxel) como índices de fila/columna del lienzo
+    ys = (np.arange(orig_h) * 2 + 1) * canvas_h // (2 * orig_h)
+    xs = (np.arange(orig_w) * 2 + 1) * canvas_w // (2 * orig_w)
+
+    # Reescalar (lienzo → original) en booleano sin pasar por PIL: se eligen primero
+    # las filas aún empaquetadas y después las columnas ya desempaquetadas
+    def to_orig(mask_bits: np.ndarray) -> np.ndarray:
+        rows = np.unpackbits(mask_bits[ys], axis=1, count=canvas_w).view(bool)
+        return np.take(rows, xs, axis=1)
+
+    keep_bool   = to_orig(keep_bits)
+    remove_bool = to_orig(remove_bits)
+
+    # Aplica correcciones sobre un único buffer nuevo (fg_bool viene de la caché)
+    refined = np.logical_or(fg_bool, keep_bool)
+    refined[remove_bool] = False
+
+    # bool → 0/255 sin pasar por int64: se reinterpreta como uint8 y se escala in situ
+    refined_u8 = refined.view(np.uint8)
+    np.multiply(refined_u8, np.uint8(255), out=refined_u8)
+    return Image.fromarray(refined_u8, mode="L")
+
+def strokes_digest(keep_bits: np.ndarray, remove_bits: np.ndarray) -> str:
+    """
+    Huella del contenido de las pinceladas (16 bytes, hex). A diferencia de un
+    contador por sesión, es una clave válida en la caché compartida entre sesiones.
+    """
+    h = hashlib.blake2b(digest_size=16)
+    h.update(keep_bits)
+    h.update(remove_bits)
+    return h.hexdigest()
+
+@st.cache_data(show_spinner=False, max_entries=16)
+def compose_refined_png(file_key: str, canvas_size: Tuple[int, int], strokes_key: str,
+                        bg_rgb: Tuple[int, int, int], max_width: int, _orig_rgb: Image.Image,
+                        _mask_L: Image.Image, _keep_bits: np.ndarray, _remove_bits: np.ndarray) -> bytes:
+    """
+    Variante cacheada para el resultado refinado: `strokes_key` (strokes_digest) cambia
+    cuando cambian las pinceladas, así que repetir «Aplicar» sin trazos nuevos no
+    recalcula nada.
+    """
+    fg_bool = get_fg_bool(file_key, _orig_rgb.size, _mask_L)
+    refined_mask_L = refine_mask(fg_bool, _keep_bits, _remove_bits, canvas_size, _orig_rgb.size)
+    return to_png(compose_on_background(_orig_rgb, refined_mask_L, bg_rgb, max_width, Image.NEAREST))
+
+def rasterize_strokes(objects: List[dict], ref: dict, canvas_size: Tuple[int, int]) -> None:
+    """
+    Vuelca los trazos vectoriales del lienzo (json_data["objects"]) en las máscaras
+    keep/remove empaquetadas del estado `ref`. El coste depende de la longitud de
+    los trazos, no de H×W como al recorrer image_data píxel a píxel.
+    Si hay más trazos que la vez anterior solo se pintan los nuevos; si hay menos
+    (deshacer, borrar) se vacían las máscaras y se redibujan todos. Los trazos se
+    pintan en una capa temporal de tres estados (0 = sin tocar, 1 = conservar,
+    2 = eliminar) del tamaño de su caja, rellenada desde las máscaras, en orden:
+    el último trazo sobre un píxel manda. En el estado solo quedan los bits.
+    """
+    w, h = canvas_size
+    new_objects = objects[ref["n_strokes"]:]
+    if len(objects) < ref["n_strokes"] or not objects:
+        ref["keep"].fill(0)
+        ref["remove"].fill(0)
+        new_objects = objects
+    ref["n_strokes"] = len(objects)
+
+    values = {KEEP_COLOR: 1, REMOVE_COLOR: 2}
+    strokes = []
+    x0, y0, x1, y1 = w, h, 0, 0
+    for obj in new_objects:
+        value = values.get(str(obj.get("stroke", "")).upper())
+        if obj.get("type") != "path" or value is None or not obj.get("path"):
+            continue
+        # Cada comando SVG (M, L, Q, C) termina en el punto (x, y) alcanzado
+        points = [(cmd[-2], cmd[-1]) for cmd in obj["path"] if len(cmd) >= 3]
+        width = max(1, int(round(obj.get("strokeWidth", 1))))
+        strokes.append((points, width, value))
+        r = width / 2
+        x0 = min(x0, math.floor(min(x for x, _ in points) - r) - 1)
+        y0 = min(y0, math.floor(min(y for _, y in points) - r) - 1)
+        x1 = max(x1, math.ceil(max(x for x, _ in points) + r) + 2)
+        y1 = max(y1, math.ceil(max(y for _, y in points) + r) + 2)
+
+    # Recortar al lienzo; x0 y x1 se alinean a 8 para que la caja ocupe bytes enteros
+    x0, y0, x1, y1 = max(0, x0) // 8 * 8, max(0, y0), min(w, -(-x1 // 8) * 8), min(h, y1)
+    if x0 >= x1 or y0 >= y1:
+        return
+
+    # Capa de la caja con lo ya pintado en ella (keep y remove no se solapan)
+    rows, cols = slice(y0, y1), slice(x0 // 8, (x1 + 7) // 8)
+    tri = np.unpackbits(ref["keep"][rows, cols], axis=1, count=x1 - x0)
+    tri += np.unpackbits(ref["remove"][rows, cols], axis=1, count=x1 - x0) * np.uint8(2)
+    layer = Image.fromarray(tri, mode="L")
+
+    draw = ImageDraw.Draw(layer)
+    for points, width, value in strokes:
+        points = [(x - x0, y - y0) for x, y in points]
+        draw.line(points, fill=value, width=width, joint="curve")
+        # Extremos redondeados, como los dibuja el pincel del lienzo
+        r = width / 2
+        for x, y in (points[0], points[-1]):
+            draw.ellipse((x - r, y - r, x + r, y + r), fill=value)
+
+    painted = np.asarray(layer)
+    ref["keep"][rows, cols] = np.packbits(np.equal(painted, 1), axis=1)
+    ref["remove"][rows, cols] = np.packbits(np.equal(painted, 2), axis=1)
 
 
 # ──────────────────────────────────────────────────────────────────────────────
@@ -97,36 +507,66 @@ uploaded_files = st.file_uploader(
 # Procesamiento
 # ──────────────────────────────────────────────────────────────────────────────
 if uploaded_files:
+    # Decodificar todas las subidas y apuntar en un lote las que aún no se han
+    # segmentado: se infieren juntas en una sola pasada ONNX. Los duplicados
+    # (mismo contenido) comparten huella, imagen decodificada y resultado.
+    batch = MaskBatch(SESSION)
+    decoded: Dict[str, Image.Image] = {}
+    jobs = []
+    zip_files: List[Tuple[str, str, bytes]] = []  # (nombre, huella, PNG) para la descarga conjunta
     for file in uploaded_files:
         # Leer bytes y validar
         try:
             file_bytes = file.getvalue()
-            orig_pil = Image.open(io.BytesIO(file_bytes)).convert("RGB")
-            orig_pil.load()
+            file_key = file_digest(file_bytes)  # única vez que se recorren los bytes para hashear
+            orig_pil = decoded.get(file_key)
+            if orig_pil is None:
+                orig_pil = decoded[file_key] = decode_upload(file_bytes, max_width)
         except Exception as e:
-            st.error(f"Archivo inválido o no soportado ({file.name}): {e}")
+            jobs.append((file, e, None, None))
             continue
+        batch.add((file_key, orig_pil.size), orig_pil)
+        jobs.append((file, None, file_key, orig_pil))
 
-        # Ejecutar rembg (cacheado)
-        with st.spinner(f"Procesando {file.name}… (la primera imagen puede tardar por carga del modelo)"):
-            fg_rgba, mask_L = get_rgba_and_mask(file_bytes)
+    # El lote se infiere en segundo plano mientras se muestran los originales
+    batch.start(_inference_executor())
+
+    for file, error, file_key, orig_pil in jobs:
+        if error is not None:
+            st.error(f"Archivo inválido o no soportado ({file.name}): {error}")
+            continue
 
-        # Resultado inicial
-        out_bytes = compose_on_background(orig_pil, mask_L, bg_color, max_width)
-        res_pil = Image.open(io.BytesIO(out_bytes)); res_pil.load()
+        # Claves de widgets y estado del pincel por tarjeta: la misma imagen subida dos
+        # veces tiene el mismo nombre y huella; solo comparte imagen y máscara
+        key_base = file.file_id
 
         st.markdown(f"### 📷 {file.name}")
         col1, col2 = st.columns([1, 1])
         with col1:
-            st.image(orig_pil, caption="Original", use_column_width=True)
+            st.image(orig_pil, caption="Original", use_column_width=True, output_format="JPEG")
         with col2:
-            st.image(res_pil, caption=f"Resultado (fondo {'personalizado' if use_custom else 'blanco'})", use_column_width=True)
+            # Segmentar (por huella; espera al lote en segundo plano si hace falta)
+            with st.spinner(f"Procesando {file.name}…"):
+                mask_L = get_mask(file_key, orig_pil, batch)
+
+            # Resultado inicial
+            out_png = compose_png(file_key, bg_color, max_width, orig_pil, mask_L)
+            stem = file.name.rsplit('.', 1)[0]
+            used_names = {name for name, _, _ in zip_files}
+            zip_name, n = f"bg_{stem}.png", 1
+            while zip_name in used_names:  # nombres repetidos: bg_a_2.png, bg_a_3.png…
+                n += 1
+                zip_name = f"bg_{stem}_{n}.png"
+            zip_files.append((zip_name, file_key, out_png))
+
+            st.image(out_png, caption=f"Resultado (fondo {'personalizado' if use_custom else 'blanco'})", use_column_width=True)
             st.download_button(
                 "⬇️ Descargar PNG",
-                data=out_bytes,
-                file_name=f"bg_{file.name.rsplit('.', 1)[0]}.png",
+                data=out_png,
+                file_name=f"bg_{stem}.png",
                 mime="image/png",
-                use_container_width=True
+                use_container_width=True,
+                key=f"download_{key_base}",
             )
 
         # ──────────────────────────────────────────────────────────────────────
@@ -142,36 +582,35 @@ if uploaded_files:
             else:
                 canvas_w, canvas_h = orig_w, orig_h
 
-            # Imagen de fondo del canvas (PIL RGB a la escala del lienzo)
-            canvas_bg = orig_pil if (orig_w == canvas_w) else orig_pil.resize((canvas_w, canvas_h), Image.LANCZOS)
-            canvas_bg_rgb = canvas_bg.convert("RGB")
-            bg_np_for_diff = np.array(canvas_bg_rgb)  # usado para detectar trazos por diferencia
+            # Imagen de fondo del canvas (PIL RGB a la escala del lienzo, cacheada)
+            canvas_bg_rgb = make_canvas_bg(file_key, orig_pil, canvas_w, canvas_h)
 
-            # Estado por archivo a resolución del lienzo
+            # Estado por tarjeta a resolución del lienzo (bits empaquetados por fila)
             def zeros_hw(h: int, w: int) -> np.ndarray:
-                return np.zeros((h, w), dtype=bool)
+                return np.zeros((h, (w + 7) // 8), dtype=np.uint8)
 
-            key_base = file.name
-            state_key = f"refine_{key_base}"
+            state_key = f"refine_{key_base}_{file_key}_{canvas_w}x{canvas_h}"
             if state_key not in st.session_state:
                 st.session_state[state_key] = {
                     "keep": zeros_hw(canvas_h, canvas_w),
                     "remove": zeros_hw(canvas_h, canvas_w),
+                    "n_strokes": 0,   # trazos ya volcados a las máscaras
+                    "canvas_ver": 0,  # se incrementa para vaciar el lienzo
                 }
 
             a, b, c = st.columns([1, 1, 1])
             with a:
-                brush = st.slider("Tamaño pincel", 5, 120, 30, step=5)
+                brush = st.slider("Tamaño pincel", 5, 120, 30, step=5, key=f"brush_{key_base}")
             with b:
                 mode = st.radio("Modo de pincel", ["Conservar (verde)", "Eliminar (rojo)"],
-                                horizontal=True, index=0)
+                                horizontal=True, index=0, key=f"mode_{key_base}")
             with c:
                 if st.button("🧽 Borrar pinceladas", key=f"clear_{key_base}"):
-                    st.session_state[state_key]["keep"][:] = False
-                    st.session_state[state_key]["remove"][:] = False
+                    rasterize_strokes([], st.session_state[state_key], (canvas_w, canvas_h))
+                    st.session_state[state_key]["canvas_ver"] += 1  # lienzo nuevo, sin trazos
                     st.rerun()
 
-            draw_color = "#00FF00" if "Conservar" in mode else "#FF0000"
+            draw_color = KEEP_COLOR if "Conservar" in mode else REMOVE_COLOR
             st.write("Dibuja sobre la imagen. Si el lienzo no aparece, reduce el tamaño del pincel.")
 
             # Canvas principal — usa PIL como background_image (no NumPy)
@@ -186,63 +625,36 @@ if uploaded_files:
                 drawing_mode="freedraw",
                 update_streamlit=True,
                 display_toolbar=True,
-                key=f"canvas_{key_base}",
+                key=f"canvas_{key_base}_{st.session_state[state_key]['canvas_ver']}",
             )
 
-            # Extraer pinceladas: comparamos contra el fondo (diferencia RGB)
-            if canvas_result.image_data is not None:
-                arr = canvas_result.image_data.astype("uint8")  # (H,W,4)
-                rgb = arr[:, :, :3]
-                # Dónde hay diferencia vs la imagen de fondo → son trazos
-                diff = np.any(rgb != bg_np_for_diff, axis=2)
-
-                # Clasificar por color (verde / rojo) con margen
-                is_green = diff & (rgb[:, :, 1] > rgb[:, :, 0] + 50) & (rgb[:, :, 1] > rgb[:, :, 2] + 50) & (rgb[:, :, 1] > 150)
-                is_red   = diff & (rgb[:, :, 0] > rgb[:, :, 1] + 50) & (rgb[:, :, 0] > rgb[:, :, 2] + 50) & (rgb[:, :, 0] > 150)
-
-                st.session_state[state_key]["keep"] |= is_green
-                st.session_state[state_key]["remove"] |= is_red
+            # Rasterizar pinceladas desde los trazos vectoriales, solo si cambió su número
+            # (los reruns por pincel, modo, color… no tocan el lienzo). Los trazos nuevos
+            # se añaden; si hay menos (deshacer en la barra del lienzo) se redibujan todos.
+            objects = (canvas_result.json_data or {}).get("objects") or []
+            ref = st.session_state[state_key]
+            if canvas_result.json_data is not None and len(objects) != ref["n_strokes"]:
+                rasterize_strokes(objects, ref, (canvas_w, canvas_h))
 
             # Aplicar refinado
             if st.button("✅ Aplicar refinado a esta imagen", key=f"apply_{key_base}"):
-                ref = st.session_state[state_key]
-
-                # Reescalar (lienzo → original)
-                def to_orig(mask_small: np.ndarray) -> Image.Image:
-                    m = (mask_small * 255).astype("uint8")
-                    m_img = Image.fromarray(m, mode="L")
-                    if (canvas_w, canvas_h) != (orig_w, orig_h):
-                        m_img = m_img.resize((orig_w, orig_h), Image.NEAREST)
-                    return m_img
-
-                keep_L_orig   = to_orig(ref["keep"])
-                remove_L_orig = to_orig(ref["remove"])
-
-                # Máscara base de IA a tamaño original
-                base = np.array(mask_L.resize((orig_w, orig_h), Image.NEAREST), dtype="uint8")
-                fg_bool = base >= 128
+                strokes_key = strokes_digest(ref["keep"], ref["remove"])
+                refined_png = compose_refined_png(file_key, (canvas_w, canvas_h), strokes_key,
+                                                  bg_color, max_width, orig_pil, mask_L,
+                                                  ref["keep"], ref["remove"])
 
-                # Aplica correcciones
-                keep_bool   = np.array(keep_L_orig, dtype="uint8") >= 128
-                remove_bool = np.array(remove_L_orig, dtype="uint8") >= 128
-                fg_bool = (fg_bool | keep_bool) & (~remove_bool)
-
-                refined_mask_L = Image.fromarray((fg_bool * 255).astype("uint8"), mode="L")
-
-                refined_bytes = compose_on_background(orig_pil, refined_mask_L, bg_color, max_width)
-                refined_pil = Image.open(io.BytesIO(refined_bytes)); refined_pil.load()
-
-                st.image(refined_pil, caption="Resultado refinado", use_column_width=True)
+                st.image(refined_png, caption="Resultado refinado", use_column_width=True)
                 st.download_button(
                     "⬇️ Descargar PNG refinado",
-                    data=refined_bytes,
-                    file_name=f"bg_refined_{file.name.rsplit('.', 1)[0]}.png",
+                    data=refined_png,
+                    file_name=f"bg_refined_{stem}.png",
                     mime="image/png",
-                    use_container_width=True
+                    use_container_width=True,
+                    key=f"download_refined_{key_base}",
                 )
 
         # Canvas de prueba (NO dentro de expander para evitar anidar)
-        show_debug = st.checkbox("🧪 Mostrar canvas de prueba", key=f"debug_toggle_{file.name}")
+        show_debug = st.checkbox("🧪 Mostrar canvas de prueba", key=f"debug_toggle_{key_base}")
         if show_debug:
             st_canvas(
                 fill_color="rgba(255,0,0,0.2)",
@@ -254,10 +666,22 @@ if uploaded_files:
                 drawing_mode="freedraw",
                 update_streamlit=True,
                 display_toolbar=True,
-                key=f"debug_canvas_{file.name}",
+                key=f"debug_canvas_{key_base}",
             )
 
         st.divider()
 
+    # Descarga conjunta de los resultados iniciales. Solo se prepara a petición:
+    # st.download_button vuelve a hashear (md5) todos sus bytes en cada rerun
+    if len(zip_files) > 1 and st.checkbox("🗜️ Preparar descarga conjunta (.zip)", key="zip_toggle"):
+        st.download_button(
+            "⬇️ Descargar todas en .zip (resultados sin refinar)",
+            data=zip_pngs(tuple((name, key) for name, key, _ in zip_files), bg_color, max_width,
+                          [png for _, _, png in zip_files]),
+            file_name="imagenes_sin_fondo.zip",
+            mime="application/zip",
+            use_container_width=True
+        )
+
 else:
-    st.info("Sube una o varias imágenes para comenzar. El modelo de IA se cargará al procesar la primera.")
+    st.info("Sube una o varias imágenes para comenzar.")